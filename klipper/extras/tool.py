@@ -27,6 +27,18 @@ class Tool:
             config, 'gcode_y_offset', None)
         self.gcode_z_offset = self._config_getfloat(
             config, 'gcode_z_offset', None)
+        self.gcode_offsets = tuple(self.get_offset())
+        # Offsets are static, prepare the commands applied on every tool change.
+        self.has_gcode_offset = any(o is not None for o in (
+            self.gcode_x_offset, self.gcode_y_offset, self.gcode_z_offset))
+        self.set_gcode_offset_cmd = 'SET_GCODE_OFFSET'
+        for axis, offset in zip('XYZ', (self.gcode_x_offset,
+                                        self.gcode_y_offset,
+                                        self.gcode_z_offset)):
+            if offset is not None:
+                self.set_gcode_offset_cmd += ' %s=%f' % (axis, offset)
+        self.bed_mesh_offset_cmd = 'BED_MESH_OFFSET X=%.6f Y=%.6f' % (
+            -self.gcode_offsets[0], -self.gcode_offsets[1])
         self.params = {**self.toolchanger.params, **toolchanger.get_params_dict(config)}
         self.modified_params = {}
         self.extruder_name = self._config_get(config, 'extruder', None)
@@ -37,6 +49,11 @@ class Tool:
         self.fan = None
         self.t_command_restore_axis = self._config_get(
             config, 't_command_restore_axis', 'XYZ')
+        try:
+            self.t_command_restore_axis_indices = toolchanger.parse_restore_axis(
+                self.t_command_restore_axis)
+        except ValueError as e:
+            raise config.error(str(e))
         self.tool_number = config.getint('tool_number', -1, minval=0)
 
         gcode = self.printer.lookup_object('gcode')
@@ -98,7 +115,7 @@ class Tool:
             gcode.register_command(name, existing)
         else:
             tc = self.main_toolchanger
-            axis = self.t_command_restore_axis
+            axis = self.t_command_restore_axis_indices
             func = lambda gcmd: tc.select_tool(
                 gcmd, tc.lookup_tool(number), axis)
             gcode.register_command(name, func, desc=desc)
@@ -4,20 +4,30 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
-import ast, bisect
-
-STATUS_UNINITALIZED = 'uninitialized'
-STATUS_INITIALIZING = 'initializing'
-STATUS_READY = 'ready'
-STATUS_CHANGING = 'changing'
-STATUS_ERROR = 'error'
+import ast, bisect, math, sys
+
+# Status is only ever set to one of these, so it is compared by identity.
+STATUS_UNINITALIZED = sys.intern('uninitialized')
+STATUS_INITIALIZING = sys.intern('initializing')
+STATUS_READY = sys.intern('ready')
+STATUS_CHANGING = sys.intern('changing')
+STATUS_ERROR = sys.intern('error')
 INIT_ON_HOME = 0
 INIT_MANUAL = 1
 INIT_FIRST_USE = 2
-XYZ_TO_INDEX = {'x': 0, 'X': 0, 'y': 1, 'Y': 1, 'z': 2, 'Z': 2}
-INDEX_TO_XYZ = 'XYZ'
+NO_OFFSETS = (0., 0., 0.)
 
 class Toolchanger:
+    # Registered with handler cmd_<NAME> and help text cmd_<NAME>_help.
+    _COMMANDS = ('INITIALIZE_TOOLCHANGER', 'SET_TOOL_TEMPERATURE',
+                 'SELECT_TOOL', 'SELECT_TOOL_ERROR', 'UNSELECT_TOOL',
+                 'TEST_TOOL_DOCKING', 'SET_TOOL_PARAMETER')
+    # Tool options that may be given defaults in the toolchanger section.
+    _TOOL_OPTIONS = ('pickup_gcode', 'dropoff_gcode', 'gcode_x_offset',
+                     'gcode_y_offset', 'gcode_z_offset',
+                     't_command_restore_axis', 'extruder', 'extruder_stepper',
+                     'fan')
+
     def __init__(self, config):
         self.printer = config.get_printer()
         self.config = config
@@ -27,6 +37,7 @@ class Toolchanger:
 
         self.name = config.get_name()
         self.params = get_params_dict(config)
+        self._params_items = tuple(self.params.items())
         init_options = {'home': INIT_ON_HOME,
                         'manual': INIT_MANUAL, 'first-use': INIT_FIRST_USE}
         self.initialize_on = config.getchoice(
@@ -40,102 +51,89 @@ class Toolchanger:
 
         # Read all the fields that might be defined on toolchanger.
         # To avoid throwing config error when no tools configured.
-        config.get('pickup_gcode', None)
-        config.get('dropoff_gcode', None)
-        config.getfloat('gcode_x_offset', None)
-        config.getfloat('gcode_y_offset', None)
-        config.getfloat('gcode_z_offset', None)
-        config.get('t_command_restore_axis', None)
-        config.get('extruder', None)
-        config.get('fan', None)
-        config.get_prefix_options('params_')
+        # params_* options are already read by get_params_dict.
+        for option in self._TOOL_OPTIONS:
+            config.get(option, None)
 
+        self._status_cache = None
+        self._status_dirty = True
         self.status = STATUS_UNINITALIZED
         self.active_tool = None
         self.tools = {}
-        self.tool_numbers = [] # Ordered list of registered tool numbers.
-        self.tool_names = [] # Tool names, in the same order as numbers.
+        self._tools_sorted = [] # (number, name) of registered tools, by number.
         self.error_message = ''
+        self._restore_axis_cache = {} # RESTORE_AXIS value -> parsed axis.
+        self.bed_mesh = None
+        self.heaters = None
 
+        self.printer.register_event_handler("klippy:connect",
+                                            self._handle_connect)
         self.printer.register_event_handler("homing:home_rails_begin",
                                             self._handle_home_rails_begin)
-        self.gcode.register_command("INITIALIZE_TOOLCHANGER",
-                                    self.cmd_INITIALIZE_TOOLCHANGER,
-                                    desc=self.cmd_INITIALIZE_TOOLCHANGER_help)
-        self.gcode.register_command("SET_TOOL_TEMPERATURE",
-                                    self.cmd_SET_TOOL_TEMPERATURE,
-                                    desc=self.cmd_SET_TOOL_TEMPERATURE_help)
-        self.gcode.register_command("SELECT_TOOL",
-                                   self.cmd_SELECT_TOOL,
-                                   desc=self.cmd_SELECT_TOOL_help)
-        self.gcode.register_command("SELECT_TOOL_ERROR",
-                                    self.cmd_SELECT_TOOL_ERROR,
-                                    desc=self.cmd_SELECT_TOOL_ERROR_help)
-        self.gcode.register_command("UNSELECT_TOOL",
-                                    self.cmd_UNSELECT_TOOL,
-                                    desc=self.cmd_UNSELECT_TOOL_help)
-        self.gcode.register_command("TEST_TOOL_DOCKING",
-                                    self.cmd_TEST_TOOL_DOCKING,
-                                    desc=self.cmd_TEST_TOOL_DOCKING_help)
-        self.gcode.register_command("SET_TOOL_PARAMETER",
-                                    self.cmd_SET_TOOL_PARAMETER)
+        for cmd in self._COMMANDS:
+            self.gcode.register_command(
+                cmd, getattr(self, 'cmd_' + cmd),
+                desc=getattr(self, 'cmd_%s_help' % (cmd,), None))
+
+    def _handle_connect(self):
+        self.bed_mesh = self.printer.lookup_object('bed_mesh', None)
+        self.heaters = self.printer.lookup_object('heaters', None)
 
     def _handle_home_rails_begin(self, homing_state, rails):
-        if self.initialize_on == INIT_ON_HOME and self.status == STATUS_UNINITALIZED:
+        if self.initialize_on == INIT_ON_HOME and self.status is STATUS_UNINITALIZED:
             self.initialize()
 
     def get_status(self, eventtime):
-        return {** self.params,
+        # Rebuilt only when status, active tool or tool assignment changes.
+        # The returned dict is shared between callers and must not be mutated.
+        if (not self._status_dirty
+                and self._status_cache['status'] is self.status):
+            return self._status_cache
+        tool_numbers, tool_names = (
+            map(list, zip(*self._tools_sorted)) if self._tools_sorted
+            else ([], []))
+        active_tool = self.active_tool
+        status = dict(self._params_items)
+        status.update({
                 'name': self.name,
                 'status': self.status,
-                'tool': self.active_tool.name if self.active_tool else None,
-                'tool_number': self.active_tool.tool_number if self.active_tool else -1,
-                'tool_numbers': self.tool_numbers,
-                'tool_names': self.tool_names,
-                }
+                'tool': active_tool.name if active_tool else None,
+                'tool_number': active_tool.tool_number if active_tool else -1,
+                'tool_numbers': tool_numbers,
+                'tool_names': tool_names,
+                })
+        self._status_cache = status
+        self._status_dirty = False
+        return status
 
     def assign_tool(self, tool, number, prev_number, replace = False):
         if number in self.tools and not replace:
             raise Exception('Duplicate tools with number %s' % (str(number)))
         if prev_number in self.tools:
             del self.tools[prev_number]
-            self.tool_numbers.remove(prev_number)
-            self.tool_names.remove(tool.name)
+            entry = (prev_number, tool.name)
+            i = bisect.bisect_left(self._tools_sorted, entry)
+            if i < len(self._tools_sorted) and self._tools_sorted[i] == entry:
+                del self._tools_sorted[i]
         self.tools[number] = tool
-        position = bisect.bisect_left(self.tool_numbers, number)
-        self.tool_numbers.insert(position, number)
-        self.tool_names.insert(position, tool.name)
+        bisect.insort(self._tools_sorted, (number, tool.name))
+        self._status_dirty = True
 
     cmd_INITIALIZE_TOOLCHANGER_help = "Initialize the toolchanger"
     def cmd_INITIALIZE_TOOLCHANGER(self, gcmd):
-        tool_name = gcmd.get('TOOL', None)
-        tool_number = gcmd.get_int('T', None)
-        tool = None
-        if tool_name:
-            tool = self.printer.lookup_object(tool_name)
-        if tool_number is not None:
-            tool = self.lookup_tool(tool_number)
-            if not tool:
-                raise gcmd.error('Tool #%d is not assigned' % (tool_number))
+        tool = self._get_tool_from_gcmd(gcmd, allow_none=True)
         self.initialize(tool)
 
     cmd_SELECT_TOOL_help = 'Select active tool'
     def cmd_SELECT_TOOL(self, gcmd):
-        tool_name = gcmd.get('TOOL', None)
-        if tool_name:
-            tool = self.printer.lookup_object(tool_name)
-            restore_axis = gcmd.get('RESTORE_AXIS', tool.t_command_restore_axis)
-            self.select_tool(gcmd, tool, restore_axis)
-            return
-        tool_nr = gcmd.get_int('T', None)
-        if tool_nr is not None:
-            tool = self.lookup_tool(tool_nr)
-            if not tool:
-                raise gcmd.error("Select tool: T%d not found" % (tool_nr))
-            restore_axis = gcmd.get('RESTORE_AXIS', tool.t_command_restore_axis)
-            self.select_tool(gcmd, tool, restore_axis)
+        tool = self._get_tool_from_gcmd(gcmd, allow_none=True)
+        if not tool:
+            raise gcmd.error("Select tool: Either TOOL or T needs to be specified")
+        if tool is self.active_tool and self.status is STATUS_READY:
+            gcmd.respond_info('Tool %s already selected' % (tool.name,))
             return
-        raise gcmd.error("Select tool: Either TOOL or T needs to be specified")
+        restore_axis = self._get_restore_axis(gcmd, tool)
+        self.select_tool(gcmd, tool, restore_axis)
 
     cmd_SET_TOOL_TEMPERATURE_help = 'Set temperature for tool'
     def cmd_SET_TOOL_TEMPERATURE(self, gcmd):
@@ -144,28 +142,30 @@ class Toolchanger:
         tool = self._get_tool_from_gcmd(gcmd)
         if not tool.extruder:
             raise gcmd.error("SET_TOOL_TEMPERATURE: No extruder specified for tool %s" % (tool.name))
-        heaters = self.printer.lookup_object('heaters')
-        heaters.set_temperature(tool.extruder.get_heater(), temp, wait)
+        self.heaters.set_temperature(tool.extruder.get_heater(), temp, wait)
 
-    def _get_tool_from_gcmd(self, gcmd):
-        tool_name = gcmd.get('TOOL', None)
-        tool_nr = gcmd.get_int('T', None)
+    def _get_tool_from_gcmd(self, gcmd, allow_none=False):
+        # Resolves TOOL or T, falling back to the active tool unless allow_none.
+        params = gcmd.get_command_parameters()
+        tool_name = params.get('TOOL')
         if tool_name:
-            tool = self.printer.lookup_object(tool_name)
-        elif tool_nr is not None:
+            return self.printer.lookup_object(tool_name)
+        if 'T' in params:
+            tool_nr = gcmd.get_int('T')
             tool = self.lookup_tool(tool_nr)
             if not tool:
-                raise gcmd.error("SET_TOOL_TEMPERATURE: T%d not found" % (tool_nr))
-        else:
-            tool = self.active_tool
-            if not tool:
-                raise gcmd.error("SET_TOOL_TEMPERATURE: No tool specified and no active tool")
-        return tool
+                raise gcmd.error("%s: T%d not found" % (gcmd.get_command(), tool_nr))
+            return tool
+        if allow_none:
+            return None
+        if not self.active_tool:
+            raise gcmd.error("%s: No tool specified and no active tool" % (gcmd.get_command()))
+        return self.active_tool
 
 
     cmd_SELECT_TOOL_ERROR_help = "Abort tool change and mark the active toolchanger as failed"
     def cmd_SELECT_TOOL_ERROR(self, gcmd):
-        if self.status != STATUS_CHANGING and self.status != STATUS_INITIALIZING:
+        if self.status is not STATUS_CHANGING and self.status is not STATUS_INITIALIZING:
             gcmd.respond_info(
                 'SELECT_TOOL_ERROR called while not selecting, doing nothing')
             return
@@ -176,35 +176,48 @@ class Toolchanger:
     def cmd_UNSELECT_TOOL(self, gcmd):
         if not self.active_tool:
             return
-        restore_axis = gcmd.get('RESTORE_AXIS', self.active_tool.t_command_restore_axis)
+        restore_axis = self._get_restore_axis(gcmd, self.active_tool)
         self.select_tool(gcmd, None, restore_axis)
 
     cmd_TEST_TOOL_DOCKING_help = "Unselect active tool and select it again"
     def cmd_TEST_TOOL_DOCKING(self, gcmd):
         if not self.active_tool:
             raise gcmd.error("Cannot test tool, no active tool")
-        restore_axis = gcmd.get('RESTORE_AXIS', self.active_tool.t_command_restore_axis)
+        restore_axis = self._get_restore_axis(gcmd, self.active_tool)
         self.test_tool_selection(gcmd, restore_axis)
 
+    def _get_restore_axis(self, gcmd, tool):
+        axis = gcmd.get('RESTORE_AXIS', None)
+        if axis is None:
+            return tool.t_command_restore_axis_indices
+        indices = self._restore_axis_cache.get(axis)
+        if indices is None:
+            try:
+                indices = parse_restore_axis(axis)
+            except ValueError as e:
+                raise gcmd.error(str(e))
+            self._restore_axis_cache[axis] = indices
+        return indices
+
     def initialize(self, select_tool=None):
-        if self.status == STATUS_CHANGING:
+        if self.status is STATUS_CHANGING:
             raise Exception('Cannot initialize while changing tools')
 
         # Initialize may be called from within the intialize gcode
         # to set active tool without performing a full change
-        should_run_initialize = self.status != STATUS_INITIALIZING
+        should_run_initialize = self.status is not STATUS_INITIALIZING
 
         if should_run_initialize:
             self.status = STATUS_INITIALIZING
-            self.run_gcode('initialize_gcode', self.initialize_gcode, {})
+            self.run_gcode('initialize_gcode', self.initialize_gcode)
 
         if select_tool:
             self._configure_toolhead_for_tool(select_tool)
-            self.run_gcode('after_change_gcode', self.after_change_gcode, {})
+            self.run_gcode('after_change_gcode', self.after_change_gcode)
             self._set_tool_gcode_offset(select_tool)
 
         if should_run_initialize:
-            if self.status == STATUS_INITIALIZING:
+            if self.status is STATUS_INITIALIZING:
                 self.status = STATUS_READY
                 self.gcode.respond_info('%s initialized, active %s' %
                                         (self.name, self.active_tool.name if self.active_tool else None))
@@ -213,23 +226,28 @@ class Toolchanger:
                                         (self.name, self.error_message))
 
     def select_tool(self, gcmd, tool, restore_axis):
-        if self.status == STATUS_UNINITALIZED and self.initialize_on == INIT_FIRST_USE:
+        if self.status is STATUS_UNINITALIZED and self.initialize_on == INIT_FIRST_USE:
             self.initialize()
-        if self.status != STATUS_READY:
+        if self.status is not STATUS_READY:
             raise gcmd.error(
                 "Cannot select tool, toolchanger status is " + self.status)
 
         if self.active_tool == tool:
-            gcmd.respond_info('Tool %s already selected' % tool.name if tool else None)
+            if tool:
+                gcmd.respond_info('Tool %s already selected' % (tool.name,))
+            else:
+                gcmd.respond_info('Tool already unselected')
             return
 
         self.status = STATUS_CHANGING
         gcode_position = self.gcode_move.get_status()['gcode_position']
+        restore_position = self._restore_position_with_tool_offset(
+            gcode_position, restore_axis, tool)
+        dropoff_tool = self.active_tool
         extra_context = {
-            'dropoff_tool': self.active_tool.name if self.active_tool else None,
+            'dropoff_tool': dropoff_tool.name if dropoff_tool else None,
             'pickup_tool': tool.name if tool else None,
-            'restore_position': self._restore_position_with_tool_offset(
-                gcode_position, restore_axis, tool)
+            'restore_position': restore_position,
         }
 
         self.gcode.run_script_from_command(
@@ -250,13 +268,12 @@ class Toolchanger:
             self.run_gcode('after_change_gcode',
                            self.after_change_gcode, extra_context)
 
-        self._restore_axis(gcode_position, restore_axis, tool)
+        self._restore_axis(restore_position)
 
-        self.gcode.run_script_from_command(
-            "RESTORE_GCODE_STATE NAME=_toolchange_state MOVE=0")
-        # Restore state sets old gcode offsets, fix that.
-        if tool is not None:
-            self._set_tool_gcode_offset(tool)
+        # Restore state sets old gcode offsets, fix that in the same script.
+        self.gcode.run_script_from_command('\n'.join(
+            ["RESTORE_GCODE_STATE NAME=_toolchange_state MOVE=0"]
+            + self._get_tool_gcode_offset_cmds(tool)))
 
         self.status = STATUS_READY
         if tool:
@@ -265,7 +282,7 @@ class Toolchanger:
             gcmd.respond_info('Tool unselected')
 
     def test_tool_selection(self, gcmd, restore_axis):
-        if self.status != STATUS_READY:
+        if self.status is not STATUS_READY:
             raise gcmd.error("Cannot test tool, toolchanger status is " + self.status)
         tool = self.active_tool
         if not tool:
@@ -274,8 +291,8 @@ class Toolchanger:
         self.status = STATUS_CHANGING
         gcode_position = self.gcode_move.get_status()['gcode_position']
         extra_context = {
-            'dropoff_tool': self.active_tool.name if self.active_tool else None,
-            'pickup_tool': tool.name if tool else None,
+            'dropoff_tool': tool.name,
+            'pickup_tool': tool.name,
             'restore_position': self._restore_position_with_tool_offset(gcode_position, restore_axis, tool)
         }
 
@@ -286,7 +303,8 @@ class Toolchanger:
         self.run_gcode('tool.pickup_gcode',
                        tool.pickup_gcode, extra_context)
 
-        self._restore_axis(gcode_position, restore_axis, None)
+        self._restore_axis(self._restore_position_with_tool_offset(
+            gcode_position, restore_axis, None))
         self.status = STATUS_READY
         gcmd.respond_info('Tool testing done')
 
@@ -300,71 +318,55 @@ class Toolchanger:
         if self.active_tool:
             self.active_tool.deactivate()
         self.active_tool = tool
+        self._status_dirty = True
         if self.active_tool:
             self.active_tool.activate()
 
     def _set_tool_gcode_offset(self, tool):
-        if tool is None:
-            return
-        if tool.gcode_x_offset is None and tool.gcode_y_offset is None and tool.gcode_z_offset is None:
-            return
-        cmd = 'SET_GCODE_OFFSET'
-        if tool.gcode_x_offset is not None:
-            cmd += ' X=%f' % (tool.gcode_x_offset,)
-        if tool.gcode_y_offset is not None:
-            cmd += ' Y=%f' % (tool.gcode_y_offset,)
-        if tool.gcode_z_offset is not None:
-            cmd += ' Z=%f' % (tool.gcode_z_offset,)
-        self.gcode.run_script_from_command(cmd)
-        mesh = self.printer.lookup_object('bed_mesh')
-        if mesh and mesh.get_mesh():
-            self.gcode.run_script_from_command('BED_MESH_OFFSET X=%.6f Y=%.6f' %
-                                                (-tool.gcode_x_offset, -tool.gcode_y_offset))
+        cmds = self._get_tool_gcode_offset_cmds(tool)
+        if cmds:
+            self.gcode.run_script_from_command('\n'.join(cmds))
+
+    def _get_tool_gcode_offset_cmds(self, tool):
+        if tool is None or not tool.has_gcode_offset:
+            return []
+        if self.bed_mesh is not None and self.bed_mesh.get_mesh():
+            return [tool.set_gcode_offset_cmd, tool.bed_mesh_offset_cmd]
+        return [tool.set_gcode_offset_cmd]
 
     def _restore_position_with_tool_offset(self, position, axis, tool):
-        result = {}
-        for i in axis:
-            index = XYZ_TO_INDEX[i]
-            v = position[index]
-            if tool:
-                offset = 0.
-                if index == 0:
-                    offset = tool.gcode_x_offset
-                elif index == 1:
-                    offset = tool.gcode_y_offset
-                elif index == 2:
-                    offset = tool.gcode_z_offset
-                v += offset
-            result[INDEX_TO_XYZ[index]] = v
-        return result
-
-    def _restore_axis(self, position, axis, tool):
-        if not axis:
+        # axis is a sequence of (index, name) pairs from parse_restore_axis.
+        offsets = tool.gcode_offsets if tool else NO_OFFSETS
+        return {c: position[index] + offsets[index] for index, c in axis}
+
+    def _restore_axis(self, pos):
+        if not pos:
             return
-        pos = self._restore_position_with_tool_offset(position, axis, tool)
         self.gcode_move.cmd_G1(self.gcode.create_gcode_command("G0", "G0", pos))
 
     def run_gcode(self, name, template, extra_context={}):
         current_status = self.status
         curtime = self.printer.get_reactor().monotonic()
         try:
-            context = {
-                **template.create_template_context(),
-                'tool': self.active_tool.get_status(curtime) if self.active_tool else {},
-                'toolchanger': self.get_status(curtime),
-                **extra_context,
-            }
+            # create_template_context() returns a new dict, extend it in place.
+            # Tool status is rebuilt per template since SET_TOOL_PARAMETER
+            # may change it mid-change, toolchanger status is memoized.
+            context = template.create_template_context()
+            context['tool'] = self.active_tool.get_status(curtime) if self.active_tool else {}
+            context['toolchanger'] = self.get_status(curtime)
+            if extra_context:
+                context.update(extra_context)
             template.run_gcode_from_command(context)
         except Exception as e:
             raise Exception("Script running error: %s" % (str(e)))
-        if current_status != self.status:
+        if current_status is not self.status:
             raise Exception("Unexpected status during %s, status = %s, message = %s, aborting" % (
                 name, self.status, self.error_message))
 
     def cmd_SET_TOOL_PARAMETER(self, gcmd):
         tool = self._get_tool_from_gcmd(gcmd)
         name = gcmd.get("PARAMETER")
-        value = ast.literal_eval(gcmd.get("VALUE"))
+        value = parse_literal(gcmd.get("VALUE"))
         tool.params[name] = value
         tool.modified_params[name] = value
 
@@ -372,13 +374,38 @@ def get_params_dict(config):
     result = {}
     for option in config.get_prefix_options('params_'):
         try:
-            result[option] = ast.literal_eval(config.get(option))
+            result[option] = parse_literal(config.get(option))
         except ValueError as e:
             raise config.error(
                 "Option '%s' in section '%s' is not a valid literal" % (
                     option, config.get_name()))
     return result
 
+def parse_literal(value):
+    # Most params are plain numbers, skip the full literal parse for those.
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        result = float(value)
+    except ValueError:
+        pass
+    else:
+        # float() also accepts nan/inf, which are not valid literals.
+        if math.isfinite(result):
+            return result
+    return ast.literal_eval(value)
+
+def parse_restore_axis(axis):
+    result = []
+    for c in axis.upper():
+        index = ord(c) - 88 # ord('X')
+        if not 0 <= index <= 2:
+            raise ValueError("Invalid restore axis '%s'" % (axis,))
+        result.append((index, c))
+    return tuple(result)
+
 def load_config(config):
     return Toolchanger(config)
 